@@ -7,140 +7,253 @@ import os
 import sys
 import subprocess
 import json
+import functools
+import pathlib
+import asyncio
+import inspect
+from importlib.util import find_spec
+from importlib.metadata import version, PackageNotFoundError
 
-def test_adb_installation():
+CONFIG_PATH = "config.json"
+
+# The first adb command after boot starts the adb server, which can take a few seconds
+ADB_SERVER_START_TIMEOUT = 10
+
+REQUIRED_IMAGES = frozenset({
+    "Career.png", "next.png", "auto_select_1.png", "auto_select_2.png",
+    "start_career_1.png", "start_career_2.png", "skip.png", "skip_btn.png",
+    "confirm.png", "skip_off.png", "menu.png", "give_up_1.png", "give_up_2.png",
+    "restore.png", "use.png", "max.png", "close.png"
+})
+
+@functools.lru_cache(maxsize=4)
+def _load_config(path, mtime):
+    """Parse a config file once per (path, mtime) so repeated checks share the result"""
+    return json.loads(pathlib.Path(path).read_bytes())
+
+def load_config(path=CONFIG_PATH):
+    """Load the config, reusing the cached parse while the file is unchanged"""
+    return _load_config(path, os.path.getmtime(path))
+
+def get_device_address(config):
+    """Return config.adb.device_address, or None when it is missing"""
+    return (config.get("adb") or {}).get("device_address")
+
+async def run_adb(*args, timeout):
+    """Run an adb command without blocking the event loop, returning (returncode, stdout)"""
+    proc = await asyncio.create_subprocess_exec(
+        "adb", *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise subprocess.TimeoutExpired(["adb", *args], timeout)
+    return proc.returncode, stdout.decode(errors="replace")
+
+async def test_adb_installation():
     """Test if ADB is available in PATH"""
+    lines = []
     try:
-        result = subprocess.run(["adb", "version"], capture_output=True, text=True, timeout=10)
-        if result.returncode == 0:
-            print("✅ ADB is installed and accessible")
-            print(f"   Version: {result.stdout.strip()}")
-            return True
+        # adb version is answered by the local binary, so it should be near instant
+        returncode, stdout = await run_adb("version", timeout=2)
+        if returncode == 0:
+            lines.append("✅ ADB is installed and accessible")
+            lines.append(f"   Version: {stdout.strip()}")
+            return True, lines
         else:
-            print("❌ ADB is installed but not working properly")
-            return False
+            lines.append("❌ ADB is installed but not working properly")
+            return False, lines
     except FileNotFoundError:
-        print("❌ ADB not found in PATH")
-        print("   Please install Android SDK Platform Tools and add to PATH")
-        return False
+        lines.append("❌ ADB not found in PATH")
+        lines.append("   Please install Android SDK Platform Tools and add to PATH")
+        return False, lines
     except subprocess.TimeoutExpired:
-        print("❌ ADB command timeout")
-        return False
+        lines.append("❌ ADB command timeout (the adb binary is not responding)")
+        return False, lines
 
 def test_config_file():
     """Test if config.json exists and is valid"""
+    lines = []
     try:
-        with open("config.json", 'r') as f:
-            config = json.load(f)
-        print("✅ config.json is valid")
-        print(f"   Device address: {config['adb']['device_address']}")
-        return True
+        config = load_config()
+        device_address = get_device_address(config)
+        if not device_address:
+            lines.append("❌ config.adb.device_address missing")
+            return False, lines
+        lines.append("✅ config.json is valid")
+        lines.append(f"   Device address: {device_address}")
+        return True, lines
     except FileNotFoundError:
-        print("❌ config.json not found")
-        return False
+        lines.append("❌ config.json not found")
+        return False, lines
     except json.JSONDecodeError:
-        print("❌ config.json contains invalid JSON")
-        return False
+        lines.append("❌ config.json contains invalid JSON")
+        return False, lines
 
 def test_template_images():
     """Test if all required template images exist"""
-    required_images = [
-        "Career.png", "next.png", "auto_select_1.png", "auto_select_2.png",
-        "start_career_1.png", "start_career_2.png", "skip.png", "skip_btn.png",
-        "confirm.png", "skip_off.png", "menu.png", "give_up_1.png", "give_up_2.png",
-        "restore.png", "use.png", "max.png", "close.png"
-    ]
-    
-    missing_images = []
-    for image in required_images:
-        image_path = os.path.join("assets", "buttons", image)
-        if not os.path.exists(image_path):
-            missing_images.append(image)
+    lines = []
+    # One directory read instead of a stat per image
+    try:
+        present = set(os.listdir(os.path.join("assets", "buttons")))
+    except FileNotFoundError:
+        present = set()
+    missing_images = sorted(REQUIRED_IMAGES - present)
     
     if not missing_images:
-        print("✅ All required template images are present")
-        return True
+        lines.append("✅ All required template images are present")
+        return True, lines
     else:
-        print("❌ Missing template images:")
+        lines.append("❌ Missing template images:")
         for image in missing_images:
-            print(f"   - {image}")
-        return False
+            lines.append(f"   - {image}")
+        return False, lines
 
-def test_adb_connection():
+async def test_adb_connection():
     """Test ADB connection to device"""
+    lines = []
+    # Load config to get device address
     try:
-        # Load config to get device address
-        with open("config.json", 'r') as f:
-            config = json.load(f)
-        
-        device_address = config['adb']['device_address']
-        
-        # Try to connect
-        result = subprocess.run(
-            ["adb", "connect", device_address],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        config = load_config()
+    except FileNotFoundError:
+        lines.append("❌ config.json not found")
+        return False, lines
+    except json.JSONDecodeError:
+        lines.append("❌ config.json contains invalid JSON")
+        return False, lines
+    
+    device_address = get_device_address(config)
+    if not device_address:
+        lines.append("❌ config.adb.device_address missing")
+        return False, lines
+    
+    try:
+        # Skip the connect handshake when the device is already attached. This is
+        # only a shortcut, so if it times out fall through to adb connect
+        try:
+            _, devices = await run_adb("devices", timeout=ADB_SERVER_START_TIMEOUT)
+            server_running = True
+        except subprocess.TimeoutExpired:
+            devices = ""
+            server_running = False
+        if f"{device_address}\tdevice" in devices.splitlines():
+            lines.append(f"✅ Already connected to {device_address}")
+            return True, lines
         
-        if "connected" in result.stdout.lower():
-            print(f"✅ Successfully connected to {device_address}")
-            return True
-        else:
-            print(f"❌ Failed to connect to {device_address}")
-            print(f"   Response: {result.stdout.strip()}")
-            return False
-            
-    except Exception as e:
-        print(f"❌ Error testing ADB connection: {e}")
-        return False
+        # Try to connect; if the server did not answer yet, connect may still
+        # have to wait for it to finish starting
+        connect_timeout = 4 if server_running else 4 + ADB_SERVER_START_TIMEOUT
+        try:
+            _, stdout = await run_adb("connect", device_address, timeout=connect_timeout)
+        except subprocess.TimeoutExpired:
+            lines.append(f"❌ Timed out connecting to {device_address} after {connect_timeout}s")
+            lines.append("   Check that the emulator is running and the address in config.json is correct")
+            if not server_running:
+                lines.append("   The adb server also did not respond; try: adb kill-server")
+            return False, lines
+    except FileNotFoundError:
+        lines.append("❌ ADB not found in PATH")
+        return False, lines
+    
+    if "connected" in stdout.lower():
+        lines.append(f"✅ Successfully connected to {device_address}")
+        return True, lines
+    else:
+        lines.append(f"❌ Failed to connect to {device_address}")
+        lines.append(f"   Response: {stdout.strip()}")
+        return False, lines
+
+def installed_version(distributions):
+    """Return the version of the first installed distribution, read from its metadata"""
+    for distribution in distributions:
+        try:
+            return version(distribution)
+        except PackageNotFoundError:
+            continue
+    return "unknown"
 
 def test_python_dependencies():
     """Test if required Python packages are installed"""
-    required_packages = ["cv2", "numpy"]
+    lines = []
+    # Module name -> (display name, distributions that provide it)
+    required_packages = {
+        "cv2": ("OpenCV", ("opencv-python", "opencv-python-headless",
+                           "opencv-contrib-python", "opencv-contrib-python-headless")),
+        "numpy": ("NumPy", ("numpy",)),
+    }
     missing_packages = []
     
-    for package in required_packages:
-        try:
-            if package == "cv2":
-                import cv2
-                print(f"✅ OpenCV version: {cv2.__version__}")
-            elif package == "numpy":
-                import numpy
-                print(f"✅ NumPy version: {numpy.__version__}")
-        except ImportError:
+    # find_spec locates the module without importing it, so OpenCV's shared
+    # libraries are not loaded just to check they exist
+    for package, (display_name, distributions) in required_packages.items():
+        if find_spec(package) is None:
             missing_packages.append(package)
+        else:
+            lines.append(f"✅ {display_name} version: {installed_version(distributions)}")
     
     if not missing_packages:
-        print("✅ All required Python packages are installed")
-        return True
+        lines.append("✅ All required Python packages are installed")
+        return True, lines
     else:
-        print("❌ Missing Python packages:")
+        lines.append("❌ Missing Python packages:")
         for package in missing_packages:
-            print(f"   - {package}")
-        print("   Run: pip install -r requirements.txt")
-        return False
+            lines.append(f"   - {package}")
+        lines.append("   Run: pip install -r requirements.txt")
+        return False, lines
+
+async def run_check(test_func):
+    """Await async checks directly and push blocking ones onto a worker thread"""
+    if inspect.iscoroutinefunction(test_func):
+        return await test_func()
+    return await asyncio.to_thread(test_func)
+
+async def run_checks(tests):
+    """Run all checks on one event loop, returning results in submission order"""
+    return await asyncio.gather(*(run_check(test_func) for _, test_func in tests))
+
+def report(tests, results):
+    """Print each check's output in order and return how many passed"""
+    passed = 0
+    for (test_name, _), (ok, lines) in zip(tests, results):
+        sys.stdout.write("\n".join([f"Testing {test_name}...", *lines]) + "\n\n")
+        if ok:
+            passed += 1
+    return passed
 
 def main():
     """Run all tests"""
     print("🔍 Testing Uma Automation Setup...\n")
     
-    tests = [
-        ("ADB Installation", test_adb_installation),
+    # Cheap local checks first; the adb checks spawn subprocesses with timeouts
+    local_tests = [
         ("Configuration File", test_config_file),
         ("Template Images", test_template_images),
-        ("Python Dependencies", test_python_dependencies),
+        ("Python Dependencies", test_python_dependencies)
+    ]
+    adb_tests = [
+        ("ADB Installation", test_adb_installation),
         ("ADB Connection", test_adb_connection)
     ]
+    run_all = "--all" in sys.argv[1:]
     
-    passed = 0
-    total = len(tests)
+    total = len(local_tests) + len(adb_tests)
     
-    for test_name, test_func in tests:
-        print(f"Testing {test_name}...")
-        if test_func():
-            passed += 1
-        print()
+    # The checks within each group are independent and mostly wait on
+    # subprocesses or disk, so run them together and report in order
+    passed = report(local_tests, asyncio.run(run_checks(local_tests)))
+    
+    if passed < len(local_tests) and not run_all:
+        skipped = ["⏭️  Skipped (prerequisite checks failed, use --all to run anyway)"]
+        report(adb_tests, [(False, skipped)] * len(adb_tests))
+        print(f"📊 Test Results: {passed}/{total} tests passed")
+        print("⚠️  Some tests failed. Please fix the issues above before running the automation.")
+        return 1
+    
+    passed += report(adb_tests, asyncio.run(run_checks(adb_tests)))
     
     print(f"📊 Test Results: {passed}/{total} tests passed")
     
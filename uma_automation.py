@@ -4,19 +4,90 @@ Uma Friend Point Farm Automation Script
 Uses ADB for screen capture and control with template matching
 """
 
+import atexit
 import json
 import time
 import cv2
 import numpy as np
 import subprocess
 import os
-from typing import Optional, Tuple
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from types import SimpleNamespace
+from typing import List, NamedTuple, Optional, Tuple
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Raw `screencap` output: minimum header size and the 4-byte-per-pixel formats
+# (RGBA_8888, RGBX_8888) that can be viewed directly as an ndarray
+RAW_SCREENCAP_HEADER = 12
+RAW_RGBA_FORMATS = (1, 2)
+# Consecutive malformed raw captures (wrong length for a supported format)
+# tolerated before giving up on raw capture for the session
+RAW_SCREENCAP_MAX_FAILURES = 3
+
+# Coarse-to-fine matching: search a downsampled pyramid level first, then
+# refine at full resolution in a small window around the coarse peak
+PYRAMID_LEVELS = 2
+PYRAMID_MIN_TEMPLATE_SIZE = 12
+PYRAMID_REFINE_MARGIN = 8
+PYRAMID_CANDIDATES = 3
+
+# Multi-match scans (use buttons) refine every coarse peak down to this score,
+# up to a fixed number of peaks, instead of matching the full frame
+PYRAMID_MULTI_THRESHOLD = 0.5
+PYRAMID_MULTI_CANDIDATES = 32
+
+# Retry polling: delays grow by RETRY_BACKOFF_FACTOR per attempt up to
+# RETRY_BACKOFF_MAX (WAIT_POLL_MAX for the timeout-based wait_* pollers), and
+# captures are spaced at least MIN_CAPTURE_INTERVAL apart
+RETRY_BACKOFF_FACTOR = 1.5
+RETRY_BACKOFF_MAX = 1.0
+WAIT_POLL_MAX = 0.5
+MIN_CAPTURE_INTERVAL = 0.1
+
+# Commands sent to the persistent adb shell are followed by an echoed marker
+# so a tap can wait until the device has actually injected it
+SHELL_ACK_MARKER = b"__OK__"
+SHELL_ACK_TIMEOUT = 5.0
+
+# Filter dialog tap positions (1080x1920 portrait) keyed by the config choice
+RARITY_COORDS = {
+    "R": (102, 408),
+    "SR": (437, 414),
+    "SSR": (777, 410),
+}
+SPECIALITY_COORDS = {
+    "SPEED": (102, 627),
+    "STAMINA": (444, 623),
+    "POWER": (786, 618),
+    "GUTS": (109, 741),
+    "WIT": (442, 732),
+    "PAL": (777, 731),
+}
+
+class Template(NamedTuple):
+    gray: np.ndarray
+    h: int
+    w: int
+    half_h: int
+    half_w: int
+    pyramid: List[np.ndarray]
+    umat: Optional[cv2.UMat]
+    path: str
+    mtime: float
+
+class GiveUpState(Enum):
+    """States of the Steps 14.5-16 flow in run_give_up_steps"""
+    CHECK_NEXT = "check_next"
+    TAP_MENU = "tap_menu"
+    GIVE_UP_1 = "give_up_1"
+
 class UmaAutomation:
     def __init__(self, config_path: str = "config.json"):
         """Initialize the automation with configuration"""
@@ -24,9 +95,47 @@ class UmaAutomation:
         self.device_address = self.config["adb"]["device_address"]
         self.template_path = self.config["adb"]["template_path"]
         self.screenshot_path = self.config["adb"]["screenshot_path"]
+        self.screen_size = None
+        self.raw_screencap = True
+        self.raw_failures = 0
+        self.shell = None
+        self.shell_seq = 0
+        self.shell_acked = 0
+        self.shell_ack = threading.Condition()
+        self.last_capture = 0.0
         
-        # Create directories if they don't exist
-        os.makedirs(self.screenshot_path, exist_ok=True)
+        # Settings the automation loop reads every cycle, resolved once here
+        automation_config = self.config.get("automation", {})
+        self.wait_time = SimpleNamespace(**automation_config.get("wait_time", {}))
+        self.manual_choose = automation_config.get("manual_choose", False)
+        self.tap_after_skip = tuple(automation_config.get("coordinates", {}).get("tap_after_skip", (249, 948)))
+        self.retry_backoff = automation_config.get("retry_backoff", 0.1)
+        
+        # OpenCV releases the GIL in matchTemplate, so independent templates can be
+        # matched concurrently; cap its internal threads to leave cores for that
+        cv2.setNumThreads(2)
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        # Also clean up when the script is used without the context manager
+        atexit.register(self.close)
+        
+        # Optionally run full-frame matches through OpenCL (transparent API)
+        self.use_opencl = self.init_opencl(automation_config.get("use_opencl", False))
+        self.frame_umat = None
+        self.frame_pyramid = None
+        
+        # Decode every template once up front instead of on each match attempt
+        self.template_dirs = [self.template_path, os.path.join("assets", "image")]
+        self.templates = {}
+        self.refresh_templates()
+        
+        # Optional per-template search regions [x, y, w, h] in screen pixels
+        rois = automation_config.get("rois", {})
+        self.rois = {name: tuple(roi) for name, roi in rois.items()}
+        next_check_roi = automation_config.get("next_check_roi")
+        self.next_check_roi = tuple(next_check_roi) if next_check_roi else None
+        
+        # Resolve the filter selection once so a typo fails at startup, not mid-run
+        self.rarity_xy, self.speciality_xy = self.resolve_filter_coords()
         
         # Test ADB connection
         self.test_adb_connection()
@@ -63,23 +172,23 @@ class UmaAutomation:
             logger.error("ADB not found. Please install Android SDK and add to PATH")
             raise
     
-    def take_screenshot(self) -> str:
-        """Take a screenshot and return the file path"""
-        timestamp = int(time.time())
-        filename = f"{self.screenshot_path}/screenshot_{timestamp}.png"
-        
+    def capture_screen(self, png: bool = False) -> bytes:
+        """Capture the device screen and return the screencap output bytes.
+
+        Without png, screencap emits its raw framebuffer format: a small header
+        (width, height, pixel format) followed by uncompressed pixels, which
+        skips the PNG encode on the device and the decode on the host.
+        """
+        command = "screencap -p" if png else "screencap"
         try:
             result = subprocess.run(
-                ["adb", "-s", self.device_address, "exec-out", "screencap -p"],
+                ["adb", "-s", self.device_address, "exec-out", command],
                 capture_output=True,
                 timeout=10
             )
             
             if result.returncode == 0:
-                with open(filename, 'wb') as f:
-                    f.write(result.stdout)
-                logger.info(f"Screenshot saved: {filename}")
-                return filename
+                return result.stdout
             else:
                 logger.error(f"Screenshot failed: {result.stderr}")
                 raise RuntimeError("Failed to take screenshot")
@@ -88,144 +197,518 @@ class UmaAutomation:
             logger.error("Screenshot timeout")
             raise
     
-    def find_template(self, template_name: str, screenshot_path: str, threshold: float = 0.8) -> Optional[Tuple[int, int]]:
-        """Find template image on screenshot using template matching"""
-        template_file = os.path.join(self.template_path, template_name)
+    def take_screenshot(self) -> np.ndarray:
+        """Take a screenshot and return it as a grayscale image, without touching disk"""
+        # Don't hammer adb when a retry loop comes straight back for another frame
+        idle = time.monotonic() - self.last_capture
+        if idle < MIN_CAPTURE_INTERVAL:
+            time.sleep(MIN_CAPTURE_INTERVAL - idle)
+        self.last_capture = time.monotonic()
         
-        if not os.path.exists(template_file):
-            logger.error(f"Template file not found: {template_file}")
-            return None
+        screenshot = None
+        if self.raw_screencap:
+            raw = self.capture_screen()
+            screenshot = self.decode_raw_screencap(raw)
+            if screenshot is not None:
+                self.raw_failures = 0
+            elif not self.raw_format_supported(raw):
+                # Unexpected pixel format; use PNG captures from now on
+                logger.warning("Raw screencap format not supported by this device, falling back to PNG")
+                self.raw_screencap = False
+            else:
+                # Supported format but the wrong length (e.g. a truncated read);
+                # use PNG for this frame only unless it keeps happening
+                self.raw_failures += 1
+                if self.raw_failures >= RAW_SCREENCAP_MAX_FAILURES:
+                    logger.warning(f"Raw screencap output malformed {self.raw_failures} times in a row, falling back to PNG")
+                    self.raw_screencap = False
+                else:
+                    logger.warning(f"Incomplete raw screencap ({len(raw)} bytes), using PNG for this frame")
+        if screenshot is None:
+            png = self.capture_screen(png=True)
+            screenshot = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_GRAYSCALE)
+            if screenshot is None:
+                logger.error("Failed to decode screenshot")
+                raise RuntimeError("Failed to take screenshot")
         
+        screen_size = (screenshot.shape[1], screenshot.shape[0])
+        if screen_size != self.screen_size:
+            if self.screen_size is not None:
+                logger.warning(f"Screen resolution changed from {self.screen_size[0]}x{self.screen_size[1]} to {screen_size[0]}x{screen_size[1]}")
+            self.screen_size = screen_size
+        return screenshot
+    
+    def raw_format_supported(self, raw: bytes) -> bool:
+        """Whether raw screencap output declares a pixel format decode_raw_screencap handles"""
+        if len(raw) < RAW_SCREENCAP_HEADER:
+            return True  # Too short to tell; treat as a partial read
+        return struct.unpack_from("<III", raw)[2] in RAW_RGBA_FORMATS
+    
+    def decode_raw_screencap(self, raw: bytes) -> Optional[np.ndarray]:
+        """Convert raw screencap output to grayscale, or None if the layout is unsupported"""
+        if len(raw) < RAW_SCREENCAP_HEADER:
+            return None
+        width, height, pixel_format = struct.unpack_from("<III", raw)
+        # The header is 12 bytes, or 16 on Android 9+ which appends a colour space
+        header_size = len(raw) - width * height * 4
+        if pixel_format not in RAW_RGBA_FORMATS or header_size not in (12, 16):
+            return None
+        rgba = np.frombuffer(raw, np.uint8, count=width * height * 4, offset=header_size)
+        return cv2.cvtColor(rgba.reshape(height, width, 4), cv2.COLOR_RGBA2GRAY)
+    
+    def take_screenshot_to_path(self) -> str:
+        """Take a screenshot, save it under screenshot_path and return the file path"""
+        os.makedirs(self.screenshot_path, exist_ok=True)
+        timestamp = int(time.time())
+        filename = f"{self.screenshot_path}/screenshot_{timestamp}.png"
+        with open(filename, 'wb') as f:
+            f.write(self.capture_screen(png=True))
+        logger.info(f"Screenshot saved: {filename}")
+        return filename
+    
+    def init_opencl(self, enabled: bool) -> bool:
+        """Enable OpenCL for UMat matching if requested and available; CPU otherwise"""
+        if not enabled:
+            return False
         try:
-            # Read images
-            screenshot = cv2.imread(screenshot_path)
-            template = cv2.imread(template_file)
-            
-            if screenshot is None or template is None:
-                logger.error("Failed to read image files")
+            if not cv2.ocl.haveOpenCL():
+                logger.warning("OpenCL requested but not available, matching on CPU")
+                return False
+            cv2.ocl.setUseOpenCL(True)
+            if not cv2.ocl.useOpenCL():
+                logger.warning("OpenCL could not be enabled, matching on CPU")
+                return False
+        except cv2.error as e:
+            logger.warning(f"OpenCL initialisation failed ({e}), matching on CPU")
+            return False
+        logger.info("OpenCL enabled for full-frame template matching")
+        return True
+    
+    def match_full_frame(self, screenshot_gray: np.ndarray, template: Template) -> np.ndarray:
+        """Run TM_CCOEFF_NORMED over a whole screenshot, on the OpenCL device when enabled.
+
+        The screenshot is uploaded once and reused for every template matched
+        against the same frame.
+        """
+        if not self.use_opencl:
+            return cv2.matchTemplate(screenshot_gray, template.gray, cv2.TM_CCOEFF_NORMED)
+        return cv2.matchTemplate(self.upload_frame(screenshot_gray), template.umat, cv2.TM_CCOEFF_NORMED).get()
+    
+    def upload_frame(self, screenshot_gray: np.ndarray) -> cv2.UMat:
+        """Return the OpenCL copy of a screenshot, uploading it once per frame"""
+        frame_umat = self.frame_umat
+        if frame_umat is None or frame_umat[0] is not screenshot_gray:
+            frame_umat = (screenshot_gray, cv2.UMat(screenshot_gray))
+            self.frame_umat = frame_umat
+        return frame_umat[1]
+    
+    def prepare_frame(self, screenshot_gray: np.ndarray):
+        """Fill the per-frame caches on the calling thread before fanning out.
+
+        Pool workers that find a stale cache would each rebuild it, so
+        concurrent searches warm it here first and then all share it.
+        """
+        self.downsample_frame(screenshot_gray, PYRAMID_LEVELS)
+        if self.use_opencl:
+            self.upload_frame(screenshot_gray)
+    
+    def downsample_frame(self, screenshot_gray: np.ndarray, level: int) -> np.ndarray:
+        """Return a screenshot pyramid level, building the levels once per frame.
+
+        Every template matched against the same frame shares the downsampled
+        copies instead of running pyrDown on the full screenshot again.
+        """
+        frame_pyramid = self.frame_pyramid
+        if frame_pyramid is None or frame_pyramid[0] is not screenshot_gray:
+            levels = [screenshot_gray]
+            for _ in range(PYRAMID_LEVELS):
+                levels.append(cv2.pyrDown(levels[-1]))
+            frame_pyramid = (screenshot_gray, levels)
+            self.frame_pyramid = frame_pyramid
+        return frame_pyramid[1][level]
+    
+    def match_candidates(self, screenshot_gray: np.ndarray, template: Template) -> np.ndarray:
+        """Full-resolution TM_CCOEFF_NORMED map computed only around coarse peaks.
+
+        Positions outside the refined windows are left at -1. Templates too
+        small for the pyramid get a plain full-frame match.
+        """
+        level = len(template.pyramid) - 1
+        if level == 0:
+            return self.match_full_frame(screenshot_gray, template)
+        h, w = template.h, template.w
+        frame_h, frame_w = screenshot_gray.shape
+        result = np.full((frame_h - h + 1, frame_w - w + 1), -1.0, dtype=np.float32)
+        coarse_template = template.pyramid[level]
+        coarse = cv2.matchTemplate(self.downsample_frame(screenshot_gray, level), coarse_template, cv2.TM_CCOEFF_NORMED)
+        coarse_h, coarse_w = coarse_template.shape
+        scale = 1 << level
+        for _ in range(PYRAMID_MULTI_CANDIDATES):
+            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(coarse)
+            if max_val < PYRAMID_MULTI_THRESHOLD:
+                break
+            x0 = max(max_loc[0] * scale - PYRAMID_REFINE_MARGIN, 0)
+            y0 = max(max_loc[1] * scale - PYRAMID_REFINE_MARGIN, 0)
+            x1 = min(max_loc[0] * scale + w + PYRAMID_REFINE_MARGIN, frame_w)
+            y1 = min(max_loc[1] * scale + h + PYRAMID_REFINE_MARGIN, frame_h)
+            if y1 - y0 >= h and x1 - x0 >= w:
+                result[y0:y1 - h + 1, x0:x1 - w + 1] = cv2.matchTemplate(screenshot_gray[y0:y1, x0:x1], template.gray, cv2.TM_CCOEFF_NORMED)
+            coarse[max(max_loc[1] - coarse_h // 2, 0):max_loc[1] + coarse_h // 2 + 1,
+                   max(max_loc[0] - coarse_w // 2, 0):max_loc[0] + coarse_w // 2 + 1] = -1.0
+        return result
+    
+    def load_template(self, template_file: str, mtime: Optional[float] = None) -> Optional[Template]:
+        """Read a template image into a grayscale Template, or None if unreadable"""
+        if mtime is None:
+            try:
+                mtime = os.stat(template_file).st_mtime
+            except OSError:
                 return None
-            
-            # Convert to grayscale for better matching
-            screenshot_gray = cv2.cvtColor(screenshot, cv2.COLOR_BGR2GRAY)
-            template_gray = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-            
+        template = cv2.imread(template_file)
+        if template is None:
+            return None
+        # Convert to grayscale for better matching
+        template_gray = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        h, w = template_gray.shape
+        # Keep downsampled levels while the template stays large enough to match reliably
+        pyramid = [template_gray]
+        while len(pyramid) <= PYRAMID_LEVELS:
+            level = cv2.pyrDown(pyramid[-1])
+            if min(level.shape) < PYRAMID_MIN_TEMPLATE_SIZE:
+                break
+            pyramid.append(level)
+        # Device-side copy for full-frame matches when OpenCL is in use
+        umat = cv2.UMat(template_gray) if self.use_opencl else None
+        return Template(template_gray, h, w, h // 2, w // 2, pyramid, umat, template_file, mtime)
+    
+    def refresh_templates(self):
+        """(Re)load every PNG in the template directories into the template index.
+
+        Templates are keyed by file name; when a name exists in several
+        directories the one from the earliest directory (the primary
+        template_path) wins.
+        """
+        templates = {}
+        for directory in self.template_dirs:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                logger.warning(f"Template directory not found: {directory}")
+                continue
+            for entry in entries:
+                if not entry.name.lower().endswith(".png") or entry.name in templates:
+                    continue
+                template = self.load_template(entry.path, entry.stat().st_mtime)
+                if template is None:
+                    logger.error(f"Failed to read template image: {entry.path}")
+                    continue
+                templates[entry.name] = template
+        self.templates = templates
+        logger.info(f"Loaded {len(templates)} template images")
+    
+    def get_template(self, template_name: str) -> Optional[Template]:
+        """Return a cached template, re-reading it if the file changed on disk"""
+        template = self.templates.get(template_name)
+        if template is None:
+            return None
+        try:
+            mtime = os.stat(template.path).st_mtime
+        except OSError:
+            # Removed or unreadable while running; keep using the cached copy
+            return template
+        if mtime != template.mtime:
+            reloaded = self.load_template(template.path, mtime)
+            if reloaded is not None:
+                logger.info(f"Reloaded modified template: {template.path}")
+                self.templates[template_name] = template = reloaded
+        return template
+    
+    def add_template_dirs(self, directories: list):
+        """Register additional template directories and index their images"""
+        known = {os.path.normpath(directory) for directory in self.template_dirs}
+        new_dirs = [directory for directory in directories if os.path.normpath(directory) not in known]
+        if new_dirs:
+            self.template_dirs.extend(new_dirs)
+            self.refresh_templates()
+    
+    def match_template(self, template_name: str, template: Template, screenshot_gray: np.ndarray, roi: Optional[Tuple[int, int, int, int]] = None) -> Tuple[float, Tuple[int, int]]:
+        """Match a cached template and return (confidence, center).
+
+        When a ROI is given, or configured for the template, only that region
+        of the screenshot is searched. Large enough templates are first located on a
+        downsampled pyramid level and then matched at full resolution only in
+        a small window around that peak. The center is in screen coordinates.
+        """
+        h, w = template.h, template.w
+        half_h, half_w = template.half_h, template.half_w
+        search_area = screenshot_gray
+        offset_x, offset_y = 0, 0
+        roi = roi or self.rois.get(template_name)
+        if roi:
+            x, y, roi_w, roi_h = roi
+            region = screenshot_gray[max(y, 0):y + roi_h, max(x, 0):x + roi_w]
+            # Fall back to the full frame if the ROI cannot contain the template
+            if region.shape[0] >= h and region.shape[1] >= w:
+                search_area = region
+                offset_x, offset_y = max(x, 0), max(y, 0)
+        
+        level = len(template.pyramid) - 1
+        if level > 0:
+            if search_area is screenshot_gray:
+                coarse_area = self.downsample_frame(screenshot_gray, level)
+            else:
+                coarse_area = search_area
+                for _ in range(level):
+                    coarse_area = cv2.pyrDown(coarse_area)
+            coarse_template = template.pyramid[level]
+            if coarse_area.shape[0] >= coarse_template.shape[0] and coarse_area.shape[1] >= coarse_template.shape[1]:
+                coarse = cv2.matchTemplate(coarse_area, coarse_template, cv2.TM_CCOEFF_NORMED)
+                coarse_h, coarse_w = coarse_template.shape
+                scale = 1 << level
+                best_val, best_center = -1.0, (0, 0)
+                # Refine the strongest few coarse peaks; downsampling can rank a
+                # look-alike region above a weaker true match
+                for _ in range(PYRAMID_CANDIDATES):
+                    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(coarse)
+                    # Map the coarse peak back to full resolution and refine around it
+                    x0 = max(max_loc[0] * scale - PYRAMID_REFINE_MARGIN, 0)
+                    y0 = max(max_loc[1] * scale - PYRAMID_REFINE_MARGIN, 0)
+                    x1 = min(max_loc[0] * scale + w + PYRAMID_REFINE_MARGIN, search_area.shape[1])
+                    y1 = min(max_loc[1] * scale + h + PYRAMID_REFINE_MARGIN, search_area.shape[0])
+                    if y1 - y0 < h or x1 - x0 < w:
+                        break
+                    result = cv2.matchTemplate(search_area[y0:y1, x0:x1], template.gray, cv2.TM_CCOEFF_NORMED)
+                    min_val, max_val, min_loc, max_loc_fine = cv2.minMaxLoc(result)
+                    if max_val > best_val:
+                        best_val = max_val
+                        best_center = (max_loc_fine[0] + x0 + offset_x + half_w, max_loc_fine[1] + y0 + offset_y + half_h)
+                    # Suppress this peak before looking for the next one
+                    coarse[max(max_loc[1] - coarse_h // 2, 0):max_loc[1] + coarse_h // 2 + 1,
+                           max(max_loc[0] - coarse_w // 2, 0):max_loc[0] + coarse_w // 2 + 1] = -1.0
+                else:
+                    return best_val, best_center
+        
+        if search_area is screenshot_gray:
+            result = self.match_full_frame(screenshot_gray, template)
+        else:
+            result = cv2.matchTemplate(search_area, template.gray, cv2.TM_CCOEFF_NORMED)
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+        center_x = max_loc[0] + offset_x + half_w
+        center_y = max_loc[1] + offset_y + half_h
+        return max_val, (center_x, center_y)
+    
+    def find_template(self, template_name: str, screenshot_gray: np.ndarray, threshold: float = 0.8, roi: Optional[Tuple[int, int, int, int]] = None) -> Optional[Tuple[int, int]]:
+        """Find template image on a grayscale screenshot using template matching.
+
+        roi ([x, y, w, h] in screen pixels) overrides the configured region for
+        this lookup only.
+        """
+        template = self.get_template(template_name)
+        
+        if template is None:
+            logger.error(f"Template file not found: {template_name} (searched {', '.join(self.template_dirs)})")
+            return None
+        
+        try:
             # Template matching
-            result = cv2.matchTemplate(screenshot_gray, template_gray, cv2.TM_CCOEFF_NORMED)
-            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+            max_val, (center_x, center_y) = self.match_template(template_name, template, screenshot_gray, roi)
             
             if max_val >= threshold:
-                # Calculate center of template
-                h, w = template_gray.shape
-                center_x = max_loc[0] + w // 2
-                center_y = max_loc[1] + h // 2
-                logger.info(f"Found {template_name} at ({center_x}, {center_y}) with confidence {max_val:.3f}")
+                logger.debug("Found %s at (%d, %d) with confidence %.3f", template_name, center_x, center_y, max_val)
                 return (center_x, center_y)
             else:
-                logger.debug(f"Template {template_name} not found (confidence: {max_val:.3f})")
+                logger.debug("Template %s not found (confidence: %.3f)", template_name, max_val)
                 return None
                 
         except Exception as e:
             logger.error(f"Error in template matching: {e}")
             return None
     
+    def find_first_of(self, template_names: list, screenshot_gray: np.ndarray, threshold: float = 0.8) -> Optional[Tuple[str, Tuple[int, int]]]:
+        """Match several templates against one screenshot concurrently.
+
+        Returns (template_name, center) for the first template in list order
+        that is found, so earlier names take priority, or None if none match.
+        """
+        found = self.find_any(template_names, screenshot_gray, threshold)
+        for template_name in template_names:
+            if found[template_name]:
+                return template_name, found[template_name]
+        return None
+    
+    def find_any(self, template_names: list, screenshot_gray: np.ndarray, threshold: float = 0.8) -> dict:
+        """Match several templates against one screenshot concurrently.
+
+        Returns {template_name: center or None} for every requested name. The
+        frame's pyramid levels are built once and shared by all the searches.
+        """
+        self.prepare_frame(screenshot_gray)
+        futures = [
+            self.pool.submit(self.find_template, template_name, screenshot_gray, threshold)
+            for template_name in template_names
+        ]
+        return {template_name: future.result() for template_name, future in zip(template_names, futures)}
+    
+    def start_shell(self):
+        """Start the long-lived adb shell that input commands are streamed into"""
+        shell = subprocess.Popen(
+            ["adb", "-s", self.device_address, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0
+        )
+        with self.shell_ack:
+            self.shell = shell
+            self.shell_seq = 0
+            self.shell_acked = 0
+        threading.Thread(target=self.read_shell_acks, args=(shell,), daemon=True).start()
+        logger.debug("Started persistent adb shell")
+    
+    def read_shell_acks(self, shell: subprocess.Popen):
+        """Record acknowledgement markers echoed by a shell until it exits"""
+        for line in shell.stdout:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == SHELL_ACK_MARKER:
+                with self.shell_ack:
+                    # Ignore a shell that has already been replaced
+                    if shell is self.shell:
+                        self.shell_acked = int(fields[1])
+                        self.shell_ack.notify_all()
+    
+    def close(self):
+        """Close the persistent adb shell and the matching thread pool"""
+        atexit.unregister(self.close)
+        self.pool.shutdown(wait=False)
+        if self.shell is None:
+            return
+        try:
+            self.shell.stdin.write(b"exit\n")
+            self.shell.stdin.close()
+            self.shell.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.shell.kill()
+        self.shell = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def shell_command(self, command: str, timeout: float = SHELL_ACK_TIMEOUT):
+        """Send a command to the persistent adb shell, restarting it once if the pipe broke.
+
+        Blocks until the shell reports the command finished, up to timeout seconds.
+        """
+        for attempt in range(2):
+            if self.shell is None or self.shell.poll() is not None:
+                self.start_shell()
+            self.shell_seq += 1
+            seq = self.shell_seq
+            try:
+                self.shell.stdin.write(f"{command}; echo {SHELL_ACK_MARKER.decode()} {seq}\n".encode())
+            except OSError as e:
+                logger.warning(f"adb shell pipe closed ({e}), restarting")
+                self.shell = None
+                continue
+            with self.shell_ack:
+                if not self.shell_ack.wait_for(lambda: self.shell_acked >= seq, timeout):
+                    raise RuntimeError(f"No response from adb shell for: {command}")
+            return
+        raise RuntimeError(f"Failed to send shell command: {command}")
+    
     def tap_coordinate(self, x: int, y: int):
         """Tap at specific coordinates"""
         try:
-            result = subprocess.run(
-                ["adb", "-s", self.device_address, "shell", "input", "tap", str(x), str(y)],
-                capture_output=True,
-                timeout=10
-            )
-            
-            if result.returncode == 0:
-                logger.info(f"Tapped at ({x}, {y})")
-            else:
-                logger.error(f"Tap failed: {result.stderr}")
-                
-        except subprocess.TimeoutExpired:
-            logger.error("Tap command timeout")
+            self.shell_command(f"input tap {x} {y}")
+            logger.info("Tapped at (%d, %d)", x, y)
+        except RuntimeError as e:
+            logger.error(f"Tap failed: {e}")
+    
+    def tap_coordinate_repeat(self, x: int, y: int, count: int, interval: float = 0.5):
+        """Tap the same spot count times, paced on the device by a single shell line.
+
+        Returns once the device has run every tap, so the next screenshot
+        already shows their result. Each tap gets the usual acknowledgement
+        allowance on top of the in-shell sleeps.
+        """
+        command = f"; sleep {interval}; ".join([f"input tap {x} {y}"] * count)
+        try:
+            self.shell_command(command, timeout=count * SHELL_ACK_TIMEOUT + (count - 1) * interval)
+            logger.info("Tapped %d times at (%d, %d)", count, x, y)
+        except RuntimeError as e:
+            logger.error(f"Tap failed: {e}")
     
     def wait(self, seconds: int):
         """Wait for specified seconds"""
         logger.info(f"Waiting {seconds} seconds...")
         time.sleep(seconds)
     
+    def backoff(self, attempt: int, max_delay: float = RETRY_BACKOFF_MAX, deadline: Optional[float] = None):
+        """Sleep before the next retry, growing from retry_backoff up to max_delay.
+
+        With a time.monotonic() deadline the sleep never runs past it.
+        """
+        delay = min(self.retry_backoff * RETRY_BACKOFF_FACTOR ** attempt, max_delay)
+        if deadline is not None:
+            delay = min(delay, max(deadline - time.monotonic(), 0.0))
+        time.sleep(delay)
+    
     def find_and_tap(self, template_name: str, max_attempts: int = 10, wait_after: int = 0) -> bool:
-        """Find template and tap it with retry logic"""
-        for attempt in range(max_attempts):
-            screenshot_path = self.take_screenshot()
+        """Find template and tap it with retry logic.
+
+        Retries keep the window of the old one-second spacing (max_attempts - 1
+        seconds) but poll with backoff inside it, so a button that appears
+        early is tapped sooner.
+        """
+        deadline = time.monotonic() + max_attempts - 1
+        attempt = 0
+        while True:
+            screenshot = self.take_screenshot()
             
-            try:
-                coords = self.find_template(template_name, screenshot_path)
-                if coords:
-                    self.tap_coordinate(coords[0], coords[1])
-                    if wait_after > 0:
-                        self.wait(wait_after)
-                    return True
-                else:
-                    logger.warning(f"Attempt {attempt + 1}/{max_attempts}: {template_name} not found")
-                    if attempt < max_attempts - 1:
-                        self.wait(1)  # Brief wait between attempts
-                        
-            finally:
-                # Clean up screenshot
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
+            coords = self.find_template(template_name, screenshot)
+            if coords:
+                self.tap_coordinate(coords[0], coords[1])
+                if wait_after > 0:
+                    self.wait(wait_after)
+                return True
+            attempt += 1
+            logger.warning(f"Attempt {attempt}: {template_name} not found")
+            if time.monotonic() >= deadline:
+                break
+            self.backoff(attempt - 1, deadline=deadline)  # Brief wait between attempts
         
-        logger.error(f"Failed to find and tap {template_name} after {max_attempts} attempts")
+        logger.error(f"Failed to find and tap {template_name} after {attempt} attempts")
         return False
 
-    def find_template_multi(self, template_name: str, screenshot_path: str, threshold: float = 0.8, extra_dirs: Optional[list] = None) -> Optional[Tuple[int, int]]:
-        """Find template by checking primary template path and optional extra directories"""
-        if extra_dirs is None:
-            extra_dirs = [os.path.join("assets", "image")]
-        # First try primary buttons directory
-        coords = self.find_template(template_name, screenshot_path, threshold)
-        if coords:
-            return coords
-        # Then try each extra directory
-        for directory in extra_dirs:
-            template_file = os.path.join(directory, template_name)
-            if not os.path.exists(template_file):
-                continue
-            try:
-                screenshot = cv2.imread(screenshot_path)
-                template = cv2.imread(template_file)
-                if screenshot is None or template is None:
-                    continue
-                screenshot_gray = cv2.cvtColor(screenshot, cv2.COLOR_BGR2GRAY)
-                template_gray = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-                result = cv2.matchTemplate(screenshot_gray, template_gray, cv2.TM_CCOEFF_NORMED)
-                min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-                if max_val >= threshold:
-                    h, w = template_gray.shape
-                    center_x = max_loc[0] + w // 2
-                    center_y = max_loc[1] + h // 2
-                    logger.info(f"Found {template_name} in {directory} at ({center_x}, {center_y}) with confidence {max_val:.3f}")
-                    return (center_x, center_y)
-            except Exception as e:
-                logger.error(f"Error searching {template_name} in {directory}: {e}")
-        return None
+    def find_template_multi(self, template_name: str, screenshot_gray: np.ndarray, threshold: float = 0.8, extra_dirs: Optional[list] = None) -> Optional[Tuple[int, int]]:
+        """Find a template from any template directory, registering extra_dirs first if given"""
+        if extra_dirs:
+            self.add_template_dirs(extra_dirs)
+        return self.find_template(template_name, screenshot_gray, threshold)
 
     def find_and_tap_multi(self, template_name: str, max_attempts: int = 10, wait_after: float = 0.0, extra_dirs: Optional[list] = None, threshold: float = 0.8) -> bool:
-        """Find and tap a template by searching multiple directories with a configurable threshold"""
-        for attempt in range(max_attempts):
-            screenshot_path = self.take_screenshot()
-            try:
-                coords = self.find_template_multi(template_name, screenshot_path, threshold, extra_dirs)
-                if coords:
-                    self.tap_coordinate(coords[0], coords[1])
-                    if wait_after > 0:
-                        time.sleep(wait_after)
-                    return True
-                else:
-                    logger.warning(f"Attempt {attempt + 1}/{max_attempts}: {template_name} not found (multi)")
-                    if attempt < max_attempts - 1:
-                        time.sleep(1)
-            finally:
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
-        logger.error(f"Failed to find and tap {template_name} (multi) after {max_attempts} attempts")
+        """Find and tap a template by searching multiple directories with a configurable threshold.
+
+        Like find_and_tap, retries poll with backoff within max_attempts - 1 seconds.
+        """
+        deadline = time.monotonic() + max_attempts - 1
+        attempt = 0
+        while True:
+            screenshot = self.take_screenshot()
+            coords = self.find_template_multi(template_name, screenshot, threshold, extra_dirs)
+            if coords:
+                self.tap_coordinate(coords[0], coords[1])
+                if wait_after > 0:
+                    time.sleep(wait_after)
+                return True
+            attempt += 1
+            logger.warning(f"Attempt {attempt}: {template_name} not found (multi)")
+            if time.monotonic() >= deadline:
+                break
+            self.backoff(attempt - 1, deadline=deadline)
+        logger.error(f"Failed to find and tap {template_name} (multi) after {attempt} attempts")
         return False
 
     def wait_and_tap_multi(self, template_name: str, timeout_seconds: float = 30.0, wait_after: float = 0.0, threshold: float = 0.8) -> tuple[bool, bool]:
@@ -237,24 +720,35 @@ class UmaAutomation:
         """
         logger.info(f"Waiting up to {timeout_seconds:.1f}s for {template_name}...")
         start_ts = time.time()
+        attempt = 0
         while time.time() - start_ts < timeout_seconds:
-            screenshot_path = self.take_screenshot()
-            try:
-                coords = self.find_template_multi(template_name, screenshot_path, threshold)
-                if coords:
-                    self.tap_coordinate(coords[0], coords[1])
-                    if wait_after > 0:
-                        time.sleep(wait_after)
-                    return True, False
-            finally:
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
-            time.sleep(0.5)
+            screenshot = self.take_screenshot()
+            coords = self.find_template_multi(template_name, screenshot, threshold)
+            if coords:
+                self.tap_coordinate(coords[0], coords[1])
+                if wait_after > 0:
+                    time.sleep(wait_after)
+                return True, False
+            self.backoff(attempt, WAIT_POLL_MAX)
+            attempt += 1
 
         logger.error(f"Timeout ({timeout_seconds:.1f}s) waiting for {template_name}")
         self.recover_to_home_or_menu()
         return False, True
 
+    def wait_until_template(self, template_names: list, timeout_seconds: float, interval: float = 0.3) -> Optional[Tuple[str, Tuple[int, int]]]:
+        """Poll until any of the templates is visible, or the timeout passes.
+
+        Returns (template_name, center) as soon as one is found, else None.
+        """
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            found = self.find_first_of(template_names, self.take_screenshot())
+            remaining = deadline - time.monotonic()
+            if found or remaining <= 0:
+                return found
+            time.sleep(min(interval, remaining))
+
     def recover_to_home_or_menu(self):
         """Fallback when a must-have step times out.
 
@@ -265,74 +759,83 @@ class UmaAutomation:
         """
         logger.warning("Starting timeout recovery: trying close/confirm, then home/menu")
 
-        # Try to tap close or confirm once if visible
+        # Try to tap close or confirm once if visible. The same frame is checked
+        # for both unless a tap changed the screen in between
+        screenshot = None
         for candidate in ["close.png", "confirm.png"]:
-            screenshot_path = self.take_screenshot()
-            try:
-                coords = self.find_template_multi(candidate, screenshot_path, 0.8)
-                if coords:
-                    logger.info(f"Recovery: Found {candidate}, tapping")
-                    self.tap_coordinate(coords[0], coords[1])
-                    time.sleep(0.5)
-            finally:
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
+            if screenshot is None:
+                screenshot = self.take_screenshot()
+            coords = self.find_template_multi(candidate, screenshot, 0.8)
+            if coords:
+                logger.info(f"Recovery: Found {candidate}, tapping")
+                self.tap_coordinate(coords[0], coords[1])
+                time.sleep(0.5)
+                screenshot = None
 
         # Now wait indefinitely until home appears, or menu appears when on a screen with Tazuna
         while True:
-            screenshot_path = self.take_screenshot()
-            try:
-                coords_home = self.find_template_multi("home.png", screenshot_path, 0.8)
-                if coords_home:
-                    logger.info("Recovery: Found home.png, tapping to return home")
-                    self.tap_coordinate(coords_home[0], coords_home[1])
-                    time.sleep(1)
-                    break
-                # Only consider Menu path if we see Tazuna on screen
-                coords_tazuna = self.find_template_multi("tazuna.png", screenshot_path, 0.8)
-                if coords_tazuna:
-                    coords_menu = self.find_template_multi("menu.png", screenshot_path, 0.8)
-                    if coords_menu:
-                        logger.info("Recovery: Found tazuna.png and menu.png, executing give up sequence")
-                        self.tap_coordinate(coords_menu[0], coords_menu[1])
-                        time.sleep(0.5)
-                        # Give up flow
-                        self.find_and_tap_multi("give_up_1.png", max_attempts=10)
-                        time.sleep(0.5)
-                        self.find_and_tap_multi("give_up_2.png", max_attempts=10)
-                        time.sleep(1)
-                        break
-            finally:
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
+            found = self.find_any(["home.png", "tazuna.png", "menu.png"], self.take_screenshot())
+            coords_home = found["home.png"]
+            if coords_home:
+                logger.info("Recovery: Found home.png, tapping to return home")
+                self.tap_coordinate(coords_home[0], coords_home[1])
+                time.sleep(1)
+                break
+            # Only consider Menu path if we see Tazuna on screen
+            coords_menu = found["menu.png"]
+            if found["tazuna.png"] and coords_menu:
+                logger.info("Recovery: Found tazuna.png and menu.png, executing give up sequence")
+                self.tap_coordinate(coords_menu[0], coords_menu[1])
+                time.sleep(0.5)
+                # Give up flow
+                self.find_and_tap_multi("give_up_1.png", max_attempts=10)
+                time.sleep(0.5)
+                self.find_and_tap_multi("give_up_2.png", max_attempts=10)
+                time.sleep(1)
+                break
             time.sleep(1.0)
 
-    def wait_and_tap_menu_if_tazuna(self, timeout_seconds: float = 30.0) -> tuple[bool, bool]:
+    def wait_and_tap_menu_if_tazuna(self, timeout_seconds: float = 30.0, screenshot: Optional[np.ndarray] = None) -> tuple[bool, bool]:
         """Wait until both tazuna.png and menu.png are visible, then tap menu.
 
-        Returns (tapped, restart_cycle). On timeout, performs recovery and
-        signals the caller to restart the automation cycle.
+        A screenshot the caller already holds is checked first instead of
+        capturing a new one. Returns (tapped, restart_cycle). On timeout,
+        performs recovery and signals the caller to restart the automation cycle.
         """
         logger.info(f"Waiting up to {timeout_seconds:.1f}s for tazuna.png + menu.png...")
         start_ts = time.time()
+        attempt = 0
         while time.time() - start_ts < timeout_seconds:
-            screenshot_path = self.take_screenshot()
-            try:
-                coords_tazuna = self.find_template_multi("tazuna.png", screenshot_path, 0.8)
-                if coords_tazuna:
-                    coords_menu = self.find_template_multi("menu.png", screenshot_path, 0.8)
-                    if coords_menu:
-                        self.tap_coordinate(coords_menu[0], coords_menu[1])
-                        return True, False
-            finally:
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
-            time.sleep(0.5)
+            if screenshot is None:
+                screenshot = self.take_screenshot()
+            found = self.find_any(["tazuna.png", "menu.png"], screenshot)
+            screenshot = None
+            coords_menu = found["menu.png"]
+            if found["tazuna.png"] and coords_menu:
+                self.tap_coordinate(coords_menu[0], coords_menu[1])
+                return True, False
+            self.backoff(attempt, WAIT_POLL_MAX)
+            attempt += 1
 
         logger.error("Timeout waiting for tazuna.png + menu.png")
         self.recover_to_home_or_menu()
         return False, True
 
+    def resolve_filter_coords(self) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        """Look up the filter tap positions for the configured rarity and speciality"""
+        filter_config = self.config.get("automation", {}).get("filter", {})
+        rarity_choice = str(filter_config.get("rarity", "SSR")).upper()
+        speciality_choice = str(filter_config.get("speciality", "POWER")).upper()
+        rarity_xy = RARITY_COORDS.get(rarity_choice)
+        speciality_xy = SPECIALITY_COORDS.get(speciality_choice)
+        # Only the manual choose flow uses the filter, so only reject bad values then
+        if self.manual_choose:
+            if rarity_xy is None:
+                raise ValueError(f"Unknown rarity selection: {rarity_choice}")
+            if speciality_xy is None:
+                raise ValueError(f"Unknown speciality selection: {speciality_choice}")
+        return rarity_xy, speciality_xy
+
     def run_filter_sequence(self) -> bool:
         """Execute the filter sequence to locate Following list based on config preferences"""
         logger.info("Starting filter sequence")
@@ -342,32 +845,10 @@ class UmaAutomation:
         # 3.2 Tap to open sorting/filter options
         self.tap_coordinate(786, 203)
         time.sleep(0.5)
-        # 3.3 Tap on Rarity and Speciality based on config
-        filter_config = self.config.get("automation", {}).get("filter", {})
-        rarity_choice = str(filter_config.get("rarity", "SSR")).upper()
-        speciality_choice = str(filter_config.get("speciality", "POWER")).upper()
-        rarity_coords = {
-            "R": (102, 408),
-            "SR": (437, 414),
-            "SSR": (777, 410),
-        }
-        speciality_coords = {
-            "SPEED": (102, 627),
-            "STAMINA": (444, 623),
-            "POWER": (786, 618),
-            "GUTS": (109, 741),
-            "WIT": (442, 732),
-            "PAL": (777, 731),
-        }
-        if rarity_choice not in rarity_coords:
-            logger.error(f"Unknown rarity selection: {rarity_choice}")
-            return False
-        if speciality_choice not in speciality_coords:
-            logger.error(f"Unknown speciality selection: {speciality_choice}")
-            return False
-        self.tap_coordinate(*rarity_coords[rarity_choice])
+        # 3.3 Tap on Rarity and Speciality based on config (resolved in __init__)
+        self.tap_coordinate(*self.rarity_xy)
         time.sleep(0.2)
-        self.tap_coordinate(*speciality_coords[speciality_choice])
+        self.tap_coordinate(*self.speciality_xy)
         time.sleep(0.2)
         # 3.4 Tap OK
         if not self.find_and_tap("ok.png", 10):
@@ -401,61 +882,50 @@ class UmaAutomation:
             logger.error("following.png not found after filter; stopping automation")
             return False
     
-    def find_use_buttons_with_brightness_filter(self, screenshot_path: str, brightness_threshold: int = 170) -> list:
+    def find_use_buttons_with_brightness_filter(self, screenshot_gray: np.ndarray, brightness_threshold: int = 170) -> list:
         """Find all use.png buttons and filter by brightness, returning unique coordinates"""
-        template_file = os.path.join(self.template_path, "use.png")
+        template = self.get_template("use.png")
         
-        if not os.path.exists(template_file):
+        if template is None:
             logger.error("Template file use.png not found")
             return []
         
         try:
-            # Read images
-            screenshot = cv2.imread(screenshot_path)
-            template = cv2.imread(template_file)
-            
-            if screenshot is None or template is None:
-                logger.error("Failed to read image files")
-                return []
+            # Template matching, at full resolution only around coarse candidates
+            result = self.match_candidates(screenshot_gray, template)
             
-            # Convert to grayscale for template matching
-            screenshot_gray = cv2.cvtColor(screenshot, cv2.COLOR_BGR2GRAY)
-            template_gray = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-            
-            # Template matching
-            result = cv2.matchTemplate(screenshot_gray, template_gray, cv2.TM_CCOEFF_NORMED)
-            
-            # Find all matches above threshold
+            # Find all matches above threshold. flatnonzero on the flat map is several
+            # times faster than a 2-D np.where; rows/cols come back via divmod
             threshold = 0.8
-            locations = np.where(result >= threshold)
-            matches = list(zip(*locations[::-1]))  # Convert to (x, y) format
+            ys, xs = np.divmod(np.flatnonzero(result >= threshold), result.shape[1])
             
-            # Filter by brightness and get unique coordinates
-            unique_coords = []
-            h, w = template_gray.shape
+            # Keep candidates whose center pixel is bright enough (disabled buttons are dimmed)
+            centers_x = xs + template.half_w
+            centers_y = ys + template.half_h
+            bright = screenshot_gray[centers_y, centers_x] > brightness_threshold
+            centers_x, centers_y = centers_x[bright], centers_y[bright]
+            scores = result[ys[bright], xs[bright]]
             
-            for match in matches:
-                x, y = match
-                center_x = x + w // 2
-                center_y = y + h // 2
-                
-                # Check brightness at center of template
-                if center_y < screenshot_gray.shape[0] and center_x < screenshot_gray.shape[1]:
-                    brightness = screenshot_gray[center_y, center_x]
-                    
-                    if brightness > brightness_threshold:
-                        # Check if this coordinate is far enough from existing ones
-                        is_unique = True
-                        for existing_coord in unique_coords:
-                            distance = np.sqrt((center_x - existing_coord[0])**2 + (center_y - existing_coord[1])**2)
-                            if distance < 50:  # Minimum distance threshold
-                                is_unique = False
-                                break
-                        
-                        if is_unique:
-                            unique_coords.append((center_x, center_y))
+            # Greedy non-maximum suppression: best score first, drop anything within 50px
+            order = np.argsort(-scores, kind="stable")
+            centers_x, centers_y = centers_x[order], centers_y[order]
+            dx = centers_x[:, None] - centers_x[None, :]
+            dy = centers_y[:, None] - centers_y[None, :]
+            too_close = dx * dx + dy * dy < 50 * 50  # Minimum distance threshold
+            suppressed = np.zeros(len(order), dtype=bool)
+            kept = []
+            for i in range(len(order)):
+                if not suppressed[i]:
+                    kept.append(i)
+                    suppressed |= too_close[i]
+            
+            # Report buttons top to bottom so the first entry is the topmost one
+            unique_coords = sorted(
+                ((int(centers_x[i]), int(centers_y[i])) for i in kept),
+                key=lambda coord: (coord[1], coord[0])
+            )
             
-            logger.info(f"Found {len(unique_coords)} unique use buttons with brightness > {brightness_threshold}")
+            logger.debug("Found %d unique use buttons with brightness > %d", len(unique_coords), brightness_threshold)
             return unique_coords
             
         except Exception as e:
@@ -476,21 +946,16 @@ class UmaAutomation:
             
             # Step 2: Find use.png buttons with brightness filter and de-duplication
             logger.info("TP Charge Step 2: Finding use.png buttons with brightness filter")
-            screenshot_path = self.take_screenshot()
-            try:
-                use_coords = self.find_use_buttons_with_brightness_filter(screenshot_path, 170)
-                if not use_coords:
-                    logger.error("No use.png buttons found with brightness filter")
-                    return False
-                
-                # Step 3: Tap first use.png button
-                logger.info("TP Charge Step 3: Tapping first use.png button")
-                first_use_coord = use_coords[0]
-                self.tap_coordinate(first_use_coord[0], first_use_coord[1])
-                
-            finally:
-                if os.path.exists(screenshot_path):
-                    os.remove(screenshot_path)
+            screenshot = self.take_screenshot()
+            use_coords = self.find_use_buttons_with_brightness_filter(screenshot, 170)
+            if not use_coords:
+                logger.error("No use.png buttons found with brightness filter")
+                return False
+            
+            # Step 3: Tap first use.png button
+            logger.info("TP Charge Step 3: Tapping first use.png button")
+            first_use_coord = use_coords[0]
+            self.tap_coordinate(first_use_coord[0], first_use_coord[1])
             self.wait(0.5)
             
             # Step 4: Find and tap max.png
@@ -520,6 +985,51 @@ class UmaAutomation:
             logger.error(f"Error in TP Charge process: {e}")
             return False
     
+    def run_give_up_steps(self) -> bool:
+        """Steps 14.5-16: clear leftover Next prompts, open the menu and tap Give Up 1.
+
+        Runs as a small state machine; when Give Up 1 cannot be found the flow
+        returns to the Next check. Returns True once Give Up 1 is tapped, or
+        False when a recovery ran and the automation cycle should restart.
+        """
+        state = GiveUpState.CHECK_NEXT
+        screenshot = None
+        while True:
+            if state == GiveUpState.CHECK_NEXT:
+                # Step 14.5: Check for If(1) happen or not
+                logger.info("Step 14.5: Checking for additional Next button opportunities")
+                screenshot = self.take_screenshot()
+                coords = self.find_template("next.png", screenshot, roi=self.next_check_roi)
+                if coords:
+                    logger.info("Found additional Next button, tapping 5 times")
+                    self.tap_coordinate_repeat(coords[0], coords[1], 5)
+                    screenshot = None
+                else:
+                    logger.info("No additional Next button found, continuing...")
+                state = GiveUpState.TAP_MENU
+            elif state == GiveUpState.TAP_MENU:
+                # Step 15: Find and tap menu.png (only when tazuna.png is present).
+                # An unchanged Step 14.5 frame serves as the first check
+                logger.info("Step 15: Finding and tapping Menu button (requires tazuna.png)")
+                tapped, restart = self.wait_and_tap_menu_if_tazuna(timeout_seconds=30.0, screenshot=screenshot)
+                screenshot = None
+                if restart or not tapped:
+                    logger.info("Recovered; restarting automation cycle")
+                    return False
+                state = GiveUpState.GIVE_UP_1
+            elif state == GiveUpState.GIVE_UP_1:
+                # Step 16: Find and tap give_up_1.png
+                logger.info("Step 16: Finding and tapping Give Up 1")
+                tapped, restart = self.wait_and_tap_multi("give_up_1.png", timeout_seconds=30.0)
+                if restart:
+                    logger.info("Recovered; restarting automation cycle")
+                    return False
+                if tapped:
+                    logger.info("Step 16 succeeded, proceeding to Step 17")
+                    return True
+                logger.error("Failed to find Give Up 1 button, returning to step 14.5")
+                state = GiveUpState.CHECK_NEXT
+
     def run_automation_loop(self):
         """Main automation loop"""
         logger.info("Starting Uma automation loop...")
@@ -540,14 +1050,14 @@ class UmaAutomation:
                 
                 # Step 2: Wait 10s
                 logger.info("Step 2: Waiting 10 seconds")
-                self.wait(self.config["automation"]["wait_time"]["career"])
+                self.wait(self.wait_time.career)
                 
                 # Step 3: Find next.png (10 attempts) and tap it, wait 1s. Do this again 1 time
                 logger.info("Step 3: Finding and tapping Next button (first time)")
                 tapped, restart = self.wait_and_tap_multi(
                     "next.png",
                     timeout_seconds=30.0,
-                    wait_after=self.config["automation"]["wait_time"]["next"]
+                    wait_after=self.wait_time.next
                 )
                 if restart:
                     logger.info("Recovered; restarting automation cycle")
@@ -561,7 +1071,7 @@ class UmaAutomation:
                 tapped, restart = self.wait_and_tap_multi(
                     "next.png",
                     timeout_seconds=30.0,
-                    wait_after=self.config["automation"]["wait_time"]["next"]
+                    wait_after=self.wait_time.next
                 )
                 if restart:
                     logger.info("Recovered; restarting automation cycle")
@@ -599,8 +1109,7 @@ class UmaAutomation:
                 self.wait(2)
                 
                 # Step 5: Manual choosing is optional; default is automatic by the game
-                manual_choose_enabled = self.config.get("automation", {}).get("manual_choose", False)
-                if manual_choose_enabled:
+                if self.manual_choose:
                     logger.info("Step 5: Manual choose enabled - running manual selection sequence")
                     if not self.manual_choose_friend():
                         logger.error("Manual choose failed; stopping automation as requested")
@@ -612,6 +1121,7 @@ class UmaAutomation:
                 logger.info("Step 6: Finding and tapping Start Career 1")
                 
                 # Local loop for Steps 6-6.5 until no TP Charge is needed
+                step6_frame = None
                 while True:
                     tapped, restart = self.wait_and_tap_multi("start_career_1.png", timeout_seconds=30.0)
                     if restart:
@@ -625,27 +1135,30 @@ class UmaAutomation:
                     
                     # Step 6.5: Check for restore.png and do TP Charge if found
                     logger.info("Step 6.5: Checking for restore.png to trigger TP Charge")
-                    screenshot_path = self.take_screenshot()
-                    try:
-                        coords = self.find_template("restore.png", screenshot_path)
-                        if coords:
-                            logger.info("Found restore.png, starting TP Charge process")
-                            if self.tp_charge():
-                                logger.info("TP Charge completed successfully, retrying Step 6")
-                                # Continue the local loop to retry start_career_1.png
-                                continue
-                            else:
-                                logger.warning("TP Charge failed, continuing with automation")
-                                break  # Exit local loop and continue to next step
+                    screenshot = self.take_screenshot()
+                    coords = self.find_template("restore.png", screenshot)
+                    if coords:
+                        logger.info("Found restore.png, starting TP Charge process")
+                        step6_frame = None
+                        if self.tp_charge():
+                            logger.info("TP Charge completed successfully, retrying Step 6")
+                            # Continue the local loop to retry start_career_1.png
+                            continue
                         else:
-                            logger.info("No restore.png found, continuing with automation")
+                            logger.warning("TP Charge failed, continuing with automation")
                             break  # Exit local loop and continue to next step
-                    finally:
-                        if os.path.exists(screenshot_path):
-                            os.remove(screenshot_path)
+                    else:
+                        logger.info("No restore.png found, continuing with automation")
+                        step6_frame = screenshot
+                        break  # Exit local loop and continue to next step
                 
-                # If we broke out of the local loop due to failure, restart main cycle
-                if not self.find_and_tap("start_career_1.png", 1):  # Quick check if we're still on the right screen
+                # If we broke out of the local loop due to failure, restart main cycle.
+                # The Step 6.5 frame already shows the confirm dialog, so check it
+                # there instead of capturing the same screen again.
+                coords = self.find_template("start_career_1.png", step6_frame) if step6_frame is not None else None
+                if coords:
+                    self.tap_coordinate(coords[0], coords[1])
+                elif not self.find_and_tap("start_career_1.png", 1):  # Quick check if we're still on the right screen
                     logger.error("Failed to complete Step 6, restarting main cycle")
                     continue
                 
@@ -661,7 +1174,7 @@ class UmaAutomation:
                 
                 # Step 8: Wait 2s
                 logger.info("Step 8: Waiting 2 seconds")
-                self.wait(self.config["automation"]["wait_time"]["start_career"])
+                self.wait(self.wait_time.start_career)
                 
                 # Step 9: Find and tap skip.png
                 logger.info("Step 9: Finding and tapping Skip button")
@@ -686,54 +1199,40 @@ class UmaAutomation:
                 
                 # Step 11: Wait 1s and Tap coordinate (249,948)
                 logger.info("Step 11: Waiting 1 second and tapping coordinate")
-                self.wait(self.config["automation"]["wait_time"]["skip"])
-                coords = self.config["automation"]["coordinates"]["tap_after_skip"]
-                self.tap_coordinate(coords[0], coords[1])
+                self.wait(self.wait_time.skip)
+                self.tap_coordinate(*self.tap_after_skip)
                 
                 # Step 12: Find skip_off.png and double tap, then check for different states
                 logger.info("Step 12: Finding skip_off.png and double tapping, then checking for different states")
-                screenshot_path = self.take_screenshot()
-                try:
-                    coords = self.find_template("skip_off.png", screenshot_path)
-                    if coords:
-                        # Double tap
-                        self.tap_coordinate(coords[0], coords[1])
-                        time.sleep(0.2)
-                        self.tap_coordinate(coords[0], coords[1])
-                        logger.info("Double tapped skip_off.png")
-                        
-                        # Wait 0.2s and check for different states
+                screenshot = self.take_screenshot()
+                coords = self.find_template("skip_off.png", screenshot)
+                if coords:
+                    # Double tap
+                    self.tap_coordinate(coords[0], coords[1])
+                    time.sleep(0.2)
+                    self.tap_coordinate(coords[0], coords[1])
+                    logger.info("Double tapped skip_off.png")
+                    
+                    # Wait 0.2s and check for different states
+                    time.sleep(0.2)
+                    screenshot_check = self.take_screenshot()
+                    # Check skip_off.png again, then skip_on_1.png, then skip_on_2.png
+                    found = self.find_first_of(["skip_off.png", "skip_on_1.png", "skip_on_2.png"], screenshot_check)
+                    state, state_coords = found if found else (None, None)
+                    if state == "skip_off.png":
+                        logger.info("Found skip_off.png again, double tapping again")
+                        self.tap_coordinate(state_coords[0], state_coords[1])
                         time.sleep(0.2)
-                        screenshot_path_check = self.take_screenshot()
-                        try:
-                            # Check for skip_off.png again
-                            coords_off = self.find_template("skip_off.png", screenshot_path_check)
-                            if coords_off:
-                                logger.info("Found skip_off.png again, double tapping again")
-                                self.tap_coordinate(coords_off[0], coords_off[1])
-                                time.sleep(0.2)
-                                self.tap_coordinate(coords_off[0], coords_off[1])
-                            else:
-                                # Check for skip_on_1.png
-                                coords_on1 = self.find_template("skip_on_1.png", screenshot_path_check)
-                                if coords_on1:
-                                    logger.info("Found skip_on_1.png, single tapping")
-                                    self.tap_coordinate(coords_on1[0], coords_on1[1])
-                                else:
-                                    # Check for skip_on_2.png
-                                    coords_on2 = self.find_template("skip_on_2.png", screenshot_path_check)
-                                    if coords_on2:
-                                        logger.info("Found skip_on_2.png, continuing...")
-                                    else:
-                                        logger.info("No specific skip state found, continuing...")
-                        finally:
-                            if os.path.exists(screenshot_path_check):
-                                os.remove(screenshot_path_check)
+                        self.tap_coordinate(state_coords[0], state_coords[1])
+                    elif state == "skip_on_1.png":
+                        logger.info("Found skip_on_1.png, single tapping")
+                        self.tap_coordinate(state_coords[0], state_coords[1])
+                    elif state == "skip_on_2.png":
+                        logger.info("Found skip_on_2.png, continuing...")
                     else:
-                        logger.warning("skip_off.png not found, continuing...")
-                finally:
-                    if os.path.exists(screenshot_path):
-                        os.remove(screenshot_path)
+                        logger.info("No specific skip state found, continuing...")
+                else:
+                    logger.warning("skip_off.png not found, continuing...")
                 
                 # Step 13: Find and tap confirm.png
                 logger.info("Step 12: Finding and tapping Confirm button")
@@ -748,87 +1247,10 @@ class UmaAutomation:
                 
                 # Step 14: Wait 5s
                 logger.info("Step 14: Waiting 5 seconds")
-                self.wait(self.config["automation"]["wait_time"]["confirm"])
-                
-                # Step 14.5: Check for If(1) happen or not
-                logger.info("Step 14.5: Checking for additional Next button opportunities")
-                screenshot_path = self.take_screenshot()
-                try:
-                    coords = self.find_template("next.png", screenshot_path)
-                    if coords:
-                        logger.info("Found additional Next button, tapping 5 times")
-                        for i in range(5):
-                            self.tap_coordinate(coords[0], coords[1])
-                            time.sleep(0.5)
-                    else:
-                        logger.info("No additional Next button found, continuing...")
-                finally:
-                    if os.path.exists(screenshot_path):
-                        os.remove(screenshot_path)
-                
-                # Step 15: Find and tap menu.png (only when tazuna.png is present)
-                logger.info("Step 15: Finding and tapping Menu button (requires tazuna.png)")
-                tapped, restart = self.wait_and_tap_menu_if_tazuna(timeout_seconds=30.0)
-                if restart:
-                    logger.info("Recovered; restarting automation cycle")
-                    continue
-                if not tapped:
-                    logger.error("Failed to find Menu button")
-                    continue
-                
-                # Step 16: Find and tap give_up_1.png
-                logger.info("Step 16: Finding and tapping Give Up 1")
+                self.wait(self.wait_time.confirm)
                 
-                # Infinite loop between steps 14.5 and 16 until step 16 succeeds
-                restart_cycle_after_16 = False
-                while True:
-                    tapped, restart_inner = self.wait_and_tap_multi("give_up_1.png", timeout_seconds=30.0)
-                    if restart_inner:
-                        logger.info("Recovered; restarting automation cycle")
-                        restart_cycle_after_16 = True
-                        break
-                    if not tapped:
-                        logger.error("Failed to find Give Up 1 button, returning to step 14.5")
-                        # Return to step 14.5: Check for additional Next button opportunities
-                        logger.info("Returning to Step 14.5: Checking for additional Next button opportunities")
-                        screenshot_path = self.take_screenshot()
-                        try:
-                            coords = self.find_template("next.png", screenshot_path)
-                            if coords:
-                                logger.info("Found additional Next button, tapping 5 times")
-                                for i in range(5):
-                                    self.tap_coordinate(coords[0], coords[1])
-                                    time.sleep(0.5)
-                            else:
-                                logger.info("No additional Next button found, continuing...")
-                        finally:
-                            if os.path.exists(screenshot_path):
-                                os.remove(screenshot_path)
-                        
-                        # After step 14.5, continue with step 15
-                        logger.info("Continuing with Step 15 after step 14.5")
-                        
-                        # Step 15: Find and tap menu.png (requires tazuna.png)
-                        logger.info("Step 15: Finding and tapping Menu button (requires tazuna.png)")
-                        tapped, restart_inner2 = self.wait_and_tap_menu_if_tazuna(timeout_seconds=30.0)
-                        if restart_inner2:
-                            logger.info("Recovered; restarting automation cycle")
-                            restart_cycle_after_16 = True
-                            break
-                        if not tapped:
-                            logger.error("Failed to find Menu button")
-                            continue
-                        
-                        # Continue the loop to retry step 16
-                        logger.info("Retrying Step 16 after step 15")
-                        continue
-                    else:
-                        # Step 16 succeeded, break out of the infinite loop
-                        logger.info("Step 16 succeeded, proceeding to Step 17")
-                        break
-                
-                # If recovery requested inside step 16, restart main cycle now
-                if restart_cycle_after_16:
+                # Steps 14.5-16, repeating from 14.5 until Give Up 1 is tapped
+                if not self.run_give_up_steps():
                     continue
 
                 # Step 17: Find and tap give_up_2.png
@@ -841,9 +1263,9 @@ class UmaAutomation:
                     logger.error("Failed to find Give Up 2 button")
                     continue
                 
-                # Step 18: Wait 5s and loop again
-                logger.info("Step 18: Waiting 5 seconds before next cycle")
-                self.wait(self.config["automation"]["wait_time"]["loop"])
+                # Step 18: Wait until the Career button is back (at most wait_time.loop) and loop again
+                logger.info(f"Step 18: Waiting up to {self.wait_time.loop} seconds for the next cycle")
+                self.wait_until_template(["Career.png"], self.wait_time.loop)
                 
                 logger.info("=== Automation cycle completed successfully ===")
                 
@@ -852,14 +1274,19 @@ class UmaAutomation:
                 break
             except Exception as e:
                 logger.error(f"Error in automation loop: {e}")
-                logger.info("Waiting 10 seconds before retrying...")
-                time.sleep(10)
+                logger.info("Waiting up to 10 seconds for the home screen before retrying...")
+                try:
+                    self.wait_until_template(["Career.png", "home.png"], 10.0)
+                except Exception as e:
+                    # Capture is failing too (e.g. adb dropped); just back off
+                    logger.error(f"Screen check failed while waiting: {e}")
+                    time.sleep(10)
 
 def main():
     """Main function"""
     try:
-        automation = UmaAutomation()
-        automation.run_automation_loop()
+        with UmaAutomation() as automation:
+            automation.run_automation_loop()
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         return 1